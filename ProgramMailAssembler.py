@@ -1,13 +1,27 @@
 from __future__ import annotations
-from typing import Optional
+from typing import Callable, Iterator, Optional
 
 from datetime import datetime
 import re
 import os
+import string
 
-from HelpersPackage import FindBracketedText, MessageLog, ReadListAsParmDict, ParmDict, GetParmFromParmDict
+from HelpersPackage import FindBracketedText, MessageLog, ReadListAsParmDict, GetParmFromParmDict
 from Log import Log, LogError, LogDisplayErrorsIfAny
 
+# Matches a [[tag]] in the email body
+_TAG_RE=re.compile(r"\[\[([^\]]*)\]\]")
+
+# Matches the next delimiter checked by CheckBalance(): a <xxx> (capturing the xxx), a [[ or a ]]
+# A "<" which is followed by another "<" before its ">" is just text
+_DELIM_RE=re.compile(r"<([^<>]*)>|\[\[|]]")
+
+# Matches the one-character name at the start of a delimiter like <a http=...>  (see CheckBalance())
+_TAG_NAME_RE=re.compile(r"^([a-zA-Z0-9])\s")
+
+# The characters which can make up the name of a <xxx>
+_TAG_NAME_CHARS=frozenset(string.ascii_letters+string.digits+" ")
+
 
 #******************************************************************************************************************************************************
 #
@@ -21,10 +35,12 @@ from Log import Log, LogError, LogDisplayErrorsIfAny
 def main():
 
     parameters=ReadListAsParmDict('parameters.txt', isFatal=True)
-    if parameters is None or len(parameters) == 0:
+    if not parameters:
         MessageLog(f"Can't open/read {os.getcwd()}/parameters.txt")
         exit(999)
     mailFormat=GetParmFromParmDict(parameters,"MailFormat").lower().strip()
+    # Choose how schedule items are to be formatted once, rather than testing mailFormat for every item
+    formatItem=FormatScheduleItemHtml if mailFormat == "html" else FormatScheduleItemText
 
     # Open the schedule markup file
     reportsdir=GetParmFromParmDict(parameters,"ProgramAnalyzerReportsdir")
@@ -35,9 +51,6 @@ def main():
         exit(999)
     with open(schedPath, "r") as file:
         markuplines=file.read()
-    # Remove newlines *outside* markup
-    markuplines=markuplines.replace(">\n<", "><")
-
     if not CheckBalance(markuplines):
         Log(f'CheckBalance failed')
         return
@@ -62,6 +75,31 @@ def main():
     mainNode=Node("Main", markuplines)
     mainNode.Resolve()
 
+    # Pull out what's needed from each person's node once, so the output loop deals only in tuples of (full name, email, schedule items)
+    # A person without a full name can't be looked up in the People table, so they're skipped here
+    # The email may be missing (None); that only matters for people who are selected to be mailed, and is checked when writing
+    persons: list[tuple[str, Optional[str], list[tuple[str, str, str, str]]]]=[]
+    for person in mainNode:
+        fullname=person["full name"]
+        if fullname is None:
+            LogError(f"While reading 'Program participant schedules.xml', a <person> has no <full name> -- skipped.")
+            continue
+        emailAddr=person["email"]
+
+        # The (title, participants, precis, equipment) of each of the <item>s in their schedule.  Missing fields are empty.
+        # If an item repeats a field, the last one wins.
+        items: list[tuple[str, str, str, str]]=[]
+        for item in person.List:
+            if item.Key != "item":
+                continue
+            fields={"title": "", "participants": "", "precis": "", "equipment": ""}
+            for subatt in item.List:
+                if subatt.Key in fields:
+                    fields[subatt.Key]=subatt.Text
+            items.append((fields["title"], fields["participants"], fields["precis"], fields["equipment"]))
+
+        persons.append((fullname, emailAddr, items))
+
     # Now read the People table
     # Format: <person>pppp</person> (repeated, one line per person)
     # pppp: <header>value</header>  (repeated, one for each column in the people tab)
@@ -74,26 +112,28 @@ def main():
         exit(999)
     with open(ppPath, "r") as file:
         peoplefile=file.read()
-    peoplelines: list[str]=[]
-    while len(peoplefile) > 0:
-        _, tag, line, peoplefile=FindAnyBracketedText(peoplefile)
-        peoplelines.append(line)
 
     # A dictionary of people, keyed by the person's full name
-    # Each person's value is a dictionary of column values from the people tab
-    people=ParmDict(CaseInsensitiveCompare=True, IgnoreSpacesCompare=True)
-    for line in peoplelines:
-        d=ParmDict(CaseInsensitiveCompare=True, IgnoreSpacesCompare=True)
-        while len(line) > 0:
-            _, header, value, line=FindAnyBracketedText(line)
+    # Each person's value is a dictionary of column values from the people tab, keyed by column header
+    # Both are plain dicts whose keys have been put through NormalizeKey() once, here, so lookups are just hashing
+    people: dict[str, dict[str, str]]={}
+    # The rows are walked in place in the file's text; only the individual cell values are copied out
+    # Every row has (nearly) the same headers, so each distinct header is normalized just once, for the whole file
+    headerKeys: dict[str, str]={}
+    for _, rowStart, rowEnd in IterBracketedSpans(peoplefile):
+        d: dict[str, str]={}
+        for header, value in IterBracketedText(peoplefile, rowStart, rowEnd):
             Log(f"{header=}  {value=}")
-            d[header]=value
-        if len(d) > 0:
-            if d.Exists("full name"):
-                people[d["full name"]]=d
+            key=headerKeys.get(header)
+            if key is None:
+                key=headerKeys[header]=NormalizeKey(header)
+            d[key]=value
+        if d:
+            if "fullname" in d:
+                people[NormalizeKey(d["fullname"])]=d
             else:
-                LogError(f"While reading 'Program participants.xml', unable to find a Full Name for \n{line}\n")
-                LogError(f"ParmDict={[x for x in d]}\n\n")
+                LogError(f"While reading 'Program participants.xml', unable to find a Full Name for \n{peoplefile[rowStart:rowEnd]}\n")
+                LogError(f"Columns={[x for x in d]}\n\n")
 
     # Read the email template.  It consists of two XMLish items, the selection criterion and the email body
     # Things in [[double brackets]] will be replaced by the corresponding cell from the person's row People page or, in the case of [[schedule]],
@@ -103,182 +143,216 @@ def main():
     if templatePath is None:
         MessageLog(f"Template file {templatePath} could not be opened")
         exit(999)
+    tmpl=ParseTemplate(templatePath)
+    if tmpl is None:
+        return
+    header, selectionvalue, emailbody, inputFileName=tmpl
+    compiledBody=CompileTemplate(emailbody)
+
+    # OK, time to produce the output
+    # We loop through all the people who have schedules, and generate emails for those who match the selection criterion.
+    # The email file is also XMLish:
+    # <person>
+    # <email>email address</email>
+    # <contents>letter...<contents>
+    # </person>  ...and repeated
+
+    # The selection criterion is the same for everyone, so normalize it once
+    headerKey=NormalizeKey(header)
+    selectionLower=selectionvalue.lower()
+
+    # Each message is written with a single write, and the file's 1MB buffer batches those writes into few system calls
+    with open(inputFileName, "w", buffering=1<<20) as file:
+        print(f"# {datetime.now()}\n", file=file)
+        for fullname, emailAddr, items in persons:
+            fullnameKey=NormalizeKey(fullname)
+            peopledata=people.get(fullnameKey)
+            if peopledata is None:
+                LogError(f"For {fullname}, {fullnameKey=} not in People -- skipped.")
+                continue
+
+            headervalue=peopledata.get(headerKey)
+            if headervalue is None:
+                LogError(f"For {fullname}, {header=} not in People's column headers -- skipped.")
+                continue
+            if headervalue.strip().lower() != selectionLower:
+                Log(f"For {fullname}, {headervalue=} does not match {selectionvalue=} -- skipped.")
+                continue
+
+            # The schedule depends only on the person, so assemble it once, before substituting into the email body
+            schedule=RenderSchedule(items, formatItem)
+
+            # Now substitute into the email body from the template and write it
+            body, missing=RenderEmail(compiledBody, peopledata, schedule)
+            if missing:
+                MessageLog(f"Can't find tag={missing[0]!r} in people.keys() for {fullname}\nAborting execution.")
+                return
+
+            if emailAddr is None:
+                LogError(f"For {fullname}, no <email> in 'Program participant schedules.xml' -- skipped.")
+                continue
+
+            file.write(f"<email-message><email-address>{emailAddr}</email-address><content>{body}\n</content></email-message>\n\n\n")
+
+
+
+    LogDisplayErrorsIfAny()
+
+
+#-------------------------------------------
+# Read and check the email template, which is parsed once per run.
+# Return a tuple of the selection criterion's header and value, the email body, and the name of the output file, or None if the template is bad
+def ParseTemplate(templatePath: str) -> Optional[tuple[str, str, str, str]]:
     with open(templatePath, "r", encoding="UTF-8") as file:
         template=file.read()
 
     if not CheckBalance(template):
         MessageLog("The template failed the CheckBalance() test -- it seems to have unbalanced HTML")
-        return
+        return None
 
     # Read the selection criterion
     # Note that the selection's header value may be empty, but it must be present, as must a (possibly empty) value
     selection, template=FindBracketedText(template, "select", stripHtml=False)
-    if len(selection) == 0:
+    if not selection:
         MessageLog(f"Template does not contain a <selection>...</selection> element")
-        return
+        return None
     header, selection=FindBracketedText(selection, "header", stripHtml=False)
     header=header.strip().lower()
-    if len(header) == 0:
+    if not header:
         MessageLog(f"<select> element does not contain a <header>...</header> element>")
-        return
+        return None
     selectionvalue, selection=FindBracketedText(selection, "value", stripHtml=False)
     selectionvalue=selectionvalue.strip()
-    if len(selectionvalue) == 0:
+    if not selectionvalue:
         MessageLog(f"<selection> element does not contain a <value>...</value> element>")
-        return
+        return None
 
     # Read the email body
     emailbody, template=FindBracketedText(template, "email body", stripHtml=False)
-    if len(emailbody) == 0:
+    if not emailbody:
         MessageLog(f"Template does not contain an <email body>...</email body> element>")
-        return
-
-    # OK, time to produce the output
-    # We loop through all the people who have schedules, and generate emails for those who match the selection criterion.
-    # The email file is also XMLish:
-    # <person>
-    # <email>email address</email>
-    # <contents>letter...<contents>
-    # </person>  ...and repeated
-
+        return None
 
     # Read the name of the input file to be used
     inputFileName, template=FindBracketedText(template, "inputFileName", stripHtml=False)
-    if len(inputFileName) == 0:
+    if not inputFileName:
         inputFileName="Program participant schedules email.txt"
 
-    with open(inputFileName, "w") as file:
-        print(f"# {datetime.now()}\n", file=file)
-        for person in mainNode:
-            fullname=person["full name"]
-            if not people.Exists(fullname):
-                LogError(f"For {fullname}, {person['full name']=} not in People -- skipped.")
-                continue
+    return header, selectionvalue, emailbody, inputFileName
 
-            peopledata=people[fullname]
-            if not peopledata.Exists(header):
-                LogError(f"For {fullname}, {header=} not in People's column headers -- skipped.")
-                continue
-            headervalue=peopledata[header]
-            if headervalue.strip().lower() != selectionvalue.lower():
-                Log(f"For {fullname}, {headervalue=} does not match {selectionvalue=} -- skipped.")
-                continue
 
-            file.write(f"<email-message>")
-            emailAddr=person["email"]
-            file.write(f"<email-address>{emailAddr}</email-address>")
-            file.write(f"<content>")
+#-------------------------------------------
+# Split the email body into the literal text between its [[tag]]s and the tags themselves, once, so that rendering it for each person
+# is just a matter of looking up values and joining.
+# Return a tuple of the list of literal segments and the list of tags; there is always one more segment than there are tags.
+# Each tag is a tuple of the (lower-case) tag as written, and, for a people column, the prefix, NormalizeKey()ed column header, and suffix.
+def CompileTemplate(emailbody: str) -> tuple[list[str], list[tuple[str, str, str, str]]]:
+    segments: list[str]=[]
+    tags: list[tuple[str, str, str, str]]=[]
+    last=0
+    for m in _TAG_RE.finditer(emailbody):
+        segments.append(emailbody[last:m.start()])
+        last=m.end()
+
+        tag=m.group(1).lower()
+        # If the tag is of the form xxx|yyy|xxx, we pass the prefix and suffix through if the center part is non-empty
+        prefix=suffix=""
+        column=tag
+        if tag != "schedule" and tag.count("|") == 2:
+            prefix, column, suffix=tag.split("|")
+        tags.append((tag, prefix, NormalizeKey(column), suffix))
+    segments.append(emailbody[last:])
+    return segments, tags
 
-            # Now substitute into the email body from the template and write it
-            # We scan for all [[xxx]] and replace it with people[person][xxx]
-            thismail=emailbody
-            while thismail.find("[[") >= 0:
-                loc1=thismail.find("[[")
-                loc2=thismail[loc1:].find("]]")
-                if loc1 >= 0 and loc2 >= 0:
-                    start=thismail[:loc1]
-                    tag=thismail[loc1+2:loc1+loc2].lower()
-                    trail=thismail[loc1+loc2+2:]
-                    # Substitute content for the tag
-                    # The tag [[schedule]] is special and fetched from a bunch of keys in the person's schedule structure
-                    # The others
-                    if tag == "schedule":
-                        items=""
-                        for attribute in person.List:
-
-                            if attribute.Key == "item":
-                                title=""
-                                participants=""
-                                precis=""
-                                equipment=""
-                                for subatt in attribute.List:
-                                    match subatt.Key:
-                                        case "title":
-                                            title=subatt.Text
-                                        case "participants":
-                                            participants=subatt.Text
-                                        case "precis":
-                                            precis=subatt.Text
-                                        case "equipment":
-                                            equipment=subatt.Text
-                                # Now format this item for the email
-                                if mailFormat == "html":
-                                    item=f"<p><b>{title}</b></p>\n<p>{participants}</p>\n"
-                                    if len(equipment) > 0:
-                                        item+=f"<p>equipment: {equipment}</p>\n"
-                                    if len(precis) > 0:
-                                        item+=f"<p>{precis}</p>\n"
-                                else:
-                                    item=f"{title}\n{participants}\n"
-                                    if len(equipment) > 0:
-                                        item+=f"equipment: {equipment}\n"
-                                    if len(precis) > 0:
-                                        item+=f"{precis}\n"
-                                # Add the item to the items text block
-                                items=items+item
-                                if mailFormat == "html":
-                                    items=items+"<p>"
-                                items=items+"\n"
-                                continue
-                        # Assemble the opening material, the items text block ansd the closing aterian into a message
-                        thismail=start+items+trail
-
-                    # All other tags come from columns of the people tab
-                    else:
-                        # If the tag is of the form xxx|yyy|xxx, we pass the prefix and suffix through if the center part is non-empty
-                        prefix=suffix=""
-                        if tag.count("|") == 2:
-                            prefix, tag, suffix=tag.split("|")
-
-                        val=people[fullname][tag]
-                        if val is None:
-                            MessageLog(f"Can't find {tag=} in people.keys() for {fullname}\nAborting execution.")
-                            return
-                        if len(val)> 0:
-                            val=prefix+val+suffix
-                        thismail=start+val+trail
-
-            file.write(thismail+"\n")
-
-            file.write(f"</content>")
-            file.write(f"</email-message>\n\n\n")
 
+#-------------------------------------------
+# Fill in a compiled email body for a person
+# The tag [[schedule]] is special and is replaced by the person's schedule.  All other tags come from columns of the people tab.
+# Return the resulting message and a list of the tags which could not be resolved
+def RenderEmail(body: tuple[list[str], list[tuple[str, str, str, str]]], peopledata: dict[str, str], schedule: str) -> tuple[str, list[str]]:
+    segments, tags=body
+    missing: list[str]=[]
+
+    out: list[str]=[segments[0]]
+    for (tag, prefix, column, suffix), segment in zip(tags, segments[1:]):
+        if tag == "schedule":
+            out.append(schedule)
+        else:
+            val=peopledata.get(column)
+            if val is None:
+                missing.append(tag)
+            elif val:
+                out.append(prefix+val+suffix)
+        out.append(segment)
 
+    return "".join(out), missing
+
+
+#-------------------------------------------
+# Assemble a person's schedule from their schedule items, each of which is a (title, participants, precis, equipment) tuple
+def RenderSchedule(items: list[tuple[str, str, str, str]], formatItem: Callable[[str, str, str, str], str]) -> str:
+    return "".join([formatItem(*item) for item in items])
 
-    LogDisplayErrorsIfAny()
+
+# Format one schedule item for a plain text email
+def FormatScheduleItemText(title: str, participants: str, precis: str, equipment: str) -> str:
+    item=f"{title}\n{participants}\n"
+    if equipment:
+        item+=f"equipment: {equipment}\n"
+    if precis:
+        item+=f"{precis}\n"
+    return item+"\n"
+
+
+# Format one schedule item for an HTML email
+def FormatScheduleItemHtml(title: str, participants: str, precis: str, equipment: str) -> str:
+    item=f"<p><b>{title}</b></p>\n<p>{participants}</p>\n"
+    if equipment:
+        item+=f"<p>equipment: {equipment}</p>\n"
+    if precis:
+        item+=f"<p>{precis}</p>\n"
+    return item+"<p>\n"
+
+
+#-------------------------------------------
+# Normalize a key from the people table so that it compares ignoring case and spaces
+# (This is the normalization a ParmDict does with CaseInsensitiveCompare and IgnoreSpacesCompare.)
+def NormalizeKey(key: str) -> str:
+    return key.lower().replace(" ", "")
 
 
 class Node:
     def __init__(self, key: str, value: str|list[Node] = ""):
-        self._key=key
+        # Keys are compared caselessly, so fold them once here rather than on every lookup
+        self._key=key.lower()
+        # Child nodes indexed by key (the first child wins when several share a key).  Filled in by Resolve()
+        self._index: dict[str, Node]={}
 
-        if type(value) == str:
-            self._value=value
-            return
-        if type(value) == list:
-            self._value=value
-            return
-
-        assert False
+        assert isinstance(value, (str, list))
+        self._value=value
+        # Whether _value is text (a leaf) or a list of Nodes.  Kept alongside _value so that accessors needn't test its type.
+        self._isText=isinstance(value, str)
 
     def __len__(self) -> int:
-        assert type(self._value) != Node
         return len(self._value)
 
-    def __getitem__(self, index):
-        if type(index) is int:
+    # node[i] is the i'th child Node.  node["key"] is the text of the first child with that key, or None if there is no such child,
+    # so callers indexing by key must check for None.
+    def __getitem__(self, index: int|str) -> Node|Optional[str]:
+        if isinstance(index, int):
             return self._value[index]
-        if type(index) is str:
-            for node in self.List:
-                if node.Key == index.lower():
-                    return node.Text
+        if isinstance(index, str):
+            node=self._index.get(index.lower())
+            if node is None:
+                return None
+            return node.Text
         assert False
 
 
 
     @property
     def IsText(self) -> bool:
-        return type(self._value) == str
+        return self._isText
 
     @property
     def Key(self) -> str:
@@ -286,41 +360,52 @@ class Node:
 
     @property
     def List(self) -> list[Node]:
-        if type(self._value) == list:
-            return self._value
-        return []
+        if self._isText:
+            return []
+        return self._value
 
     @property
     def Text(self) -> str:
-        if type(self._value) == str:
+        if self._isText:
             return self._value
         return ""
 
-    # Recursively parse the markup
+    # Parse the markup
     def Resolve(self) -> Node:
-        # Replace the list of strings with a list of dicts for each xxx and then call resolve for each of those
-        # Find the first (perhaps only) markup in the list of strings
-
+        # Replace the text with a list of Nodes for each <xxx>...</xxx> in it and then resolve each of those in turn
+        # The whole tree is built by walking the original text by index, so the only strings created are the keys and the leaf values
+        # Rather than recursing, the nodes still to be resolved are kept on a stack along with the span of text which holds their markup
+        if not self._isText:
+            return self
         text=self._value
 
-        out: list[Node]=[]
-        while len(text) > 0:
-            lead, bracket, contents, trail=FindAnyBracketedText(text)
-            if bracket == "" and contents == "":
-                if trail != "":
-                    #print(f"[({key}, {trail})]")
-                    self._value=trail
-                    return self
-                if trail == "":
+        stack: list[tuple[Node, int, int]]=[(self, 0, len(text))]
+        while stack:
+            node, start, end=stack.pop()
+            out: list[Node]=[]
+            pos=start
+            while True:
+                span=FindBracketedSpan(text, pos, end)
+                if span is None:
                     break
-            node=Node(bracket, contents)
-            node.Resolve()
-            out.append(node)
-            text=trail
-
-        #print(f"[({key}, {len(out)=})]")
-        if out:
-            self._value=out
+                _, bracket, contentStart, contentEnd, pos=span
+                child=Node(bracket)
+                out.append(child)
+                stack.append((child, contentStart, contentEnd))
+
+            #print(f"[({node.Key}, {len(out)=})]")
+            if out:
+                node._value=out
+                node._isText=False
+                # Reversed so that the first of several same-keyed children is the one indexed
+                node._index={child.Key: child for child in reversed(out)}
+            else:
+                # No markup, so this is a leaf and its value is just the text
+                # Whitespace between tags is simply skipped by the scanner.  A leaf which is exactly "\n" (e.g., <precis>\n</precis>) is treated as empty.
+                node._value=text[start:end]
+                if node._value == "\n":
+                    node._value=""
+                node._isText=True
         return self
 
 #-------------------------------------------
@@ -331,102 +416,68 @@ def CheckBalance(s: str) -> bool:
 
     nesting: list[str]=[]
 
-    # Remove the line ends as they just make Regex harder.
-    s=s.replace("\n", " ")
-
-    while s:
-        delim, s=LocateNextDelimiter(s)
-        #Log(f"CheckBalance:  {delim=}    {s=}")
-        if (delim is None or delim == "") and nesting:
-            MessageLog(f"Template error: Unbalanced delimiters found around '{s}\nProgramMailAssembler terminated.")
-            return False
-
+    # Find all the delimiters in a single pass
+    for m in _DELIM_RE.finditer(s):
+        # For <xxx>, the delimiter is xxx.  For [[ and ]], the delimiter is [[ or ]]
+        delim=m.group(1)
+        if delim is None:
+            delim=m.group(0)
+        pos=m.end()
+        #Log(f"CheckBalance:  {delim=}    {pos=}")
         if delim == "":
-            return True
+            continue
 
         # Is this a new opening delimiter?
-        if delim == "[[" or delim[0] != "/":
-            m=re.match("^([a-zA-Z0-9])\\s", delim)   # Check for cases like <a http=...> -- the delim is just the a
-            if m is not None:
-                delim=m.groups()[0]
+        if delim == "[[" or (delim != "]]" and delim[0] != "/"):
+            mName=_TAG_NAME_RE.match(delim)   # Check for cases like <a http=...> -- the delim is just the a
+            if mName is not None:
+                delim=mName.groups()[0]
             nesting.append(delim)
-            #Log(f"CheckBalance: push '{delim}'   {s=}")
+            #Log(f"CheckBalance: push '{delim}'   {pos=}")
             continue
 
         # We have a delimiter and it is not an opening delim, so it much be a closing delim.  Is there anything left on the stack to match?
         if not nesting:
-            MessageLog(f"CheckBalance: Error -- missing ]] near '{s}\nProgramMailAssembler terminated.")
+            MessageLog(f"CheckBalance: Error -- missing ]] near '{s[pos:]}\nProgramMailAssembler terminated.")
             return False
 
         top=nesting.pop()
-        #Log(f"CheckBalance: pop '{top}'   {s=}")
+        #Log(f"CheckBalance: pop '{top}'   {pos=}")
 
         if delim == "]]":
             if top != "[[":
-                MessageLog(f"CheckBalance: Error -- Unbalanced [[]] near '{s}\nProgramMailAssembler terminated.")
+                MessageLog(f"CheckBalance: Error -- Unbalanced [[]] near '{s[pos:]}\nProgramMailAssembler terminated.")
                 return False
             continue
 
         if delim[0] == "/":
             if top == delim[1:]:
                 continue
-            MessageLog(f"CheckBalance: Error -- Unbalanced <>...</> near '{s}\nProgramMailAssembler terminated.")
+            MessageLog(f"CheckBalance: Error -- Unbalanced <>...</> near '{s[pos:]}\nProgramMailAssembler terminated.")
             return False
 
+    # We ran off the end of the string.  Is anything still open?
+    if nesting:
+        MessageLog(f"Template error: Unbalanced delimiters found -- '{nesting[-1]}' is never closed\nProgramMailAssembler terminated.")
+        return False
     return True
 
-# Scan for the next opening or closing delimiter.
-# Return a tuple of the delimiter found and the remaining text
-# For <xxx>, the delimiter returned is xxx. For [[xxx]], the delimiter returned is [[
-# Return (None, str) on error
-def LocateNextDelimiter(s: str) -> tuple[Optional[str], str]:
-    if not s:
-        return "", ""
-
-    # Match <stuff> followed by "<" followed by stuff not containing delimiters, followed by ">", followed by stuff
-    m1=re.match("^[^<]*?<([^<>\\[\\]]*?)>", s)
-    m2=re.match("^[^\[]*?\[\[([^<>\\[\\]]]*?)]", s)
-
-    # Neither found means we're done.
-    if m1 is None and m2 is None:
-        #Log(f"LocateNextDelimiter: m1=m2=None")
-        return "", ""
-
-    if m1 is not None and m2 is None:
-        #Log(f"LocateNextDelimiter: m1 ends at {m1.regs[0][1]}")
-        return m1.groups()[0], s[m1.regs[0][1]:]
-
-    if m1 is None and m2 is not None:
-        #Log(f"LocateNextDelimiter: m2 ends at {m2.regs[0][1]}")
-        return "[[", s[m2.regs[0][1]:]
-
-    # Both found. Which is first?
-    #Log(f"LocateNextDelimiter: m1 ends at {m1.regs[0][1]} and m2 ends at {m2.regs[0][1]}")
-    if m1.regs[0][1] < m2.regs[0][1]:
-        return m1.groups()[0], s[m1.regs[0][1]:]
-    else:
-        return "[[", s[m2.regs[0][1]:]
-
 #-------------------------------------------------
 # Search for a Program file and return its path.
-# Look first in the location specified by path.  Failing that, look in defaultDir.  Failing that look in the CWD.
+# Look first in the location specified by path.  Failing that, look in the CWD.
 def OpenProgramFile(fname: str, path: str, report=True) -> Optional[str]:
     if fname is None:
         MessageLog(f"OpenProgramFile: fname is None, {path=}")
         return None
 
-    if path is not None:
-        pathname=os.path.join(path, fname)
+    # Try path/fname, then fname relative to the CWD
+    candidates=[fname]
+    if path and path != ".":
+        candidates.insert(0, os.path.join(path, fname))
+    for pathname in candidates:
         if os.path.exists(pathname):
             return pathname
 
-    pathname=os.path.join(".", fname)
-    if os.path.exists(pathname):
-        return pathname
-
-    if os.path.exists(fname):
-        return fname
-
     if report:
         if path != ".":
             MessageLog(f"Can't find '{fname}': checked '{path}' and './'")
@@ -436,24 +487,59 @@ def OpenProgramFile(fname: str, path: str, report=True) -> Optional[str]:
     return None
 
 #=====================================================================================
-# Note this is a carient of a method from HelpersFile
-# Find first text bracketed by <anything>...</anything>
-# Return a tuple consisting of:
-#   Any leading material
-#   The name of the first pair of brackets found
-#   The contents of the first pair of brackets found
-#   The remainder of the input string
-# Note that this is a *non-greedy* scanner
-# Note also that it is not very tolerant of errors in the bracketing, just dropping things on the floor
-def FindAnyBracketedText(s: str) -> tuple[str, str, str, str]:
-
-    pattern=r"^(.*?)<([a-zA-Z0-9 ]+)[^>]*?>(.*?)<\/\2>"
-    m=re.search(pattern, s,  re.DOTALL)
-    if m is None:
-        return s, "", "", ""
-
-    x=m.group(1), m.group(2), m.group(3), s[m.regs[0][1]:]
-    return x
+# Find the first text bracketed by <anything>...</anything> in s[pos:end] without slicing s
+# This is a plain str.find scanner (no regex backtracking)
+# A bracket's name is letters, digits and spaces, and its contents run to the first matching </name>
+# Note that this is a *non-greedy* scanner, and that it is not very tolerant of errors in the bracketing, just dropping things on the floor
+# Return None if there is none, else a tuple consisting of:
+#   The index of the opening <
+#   The name of the brackets found
+#   The index of the start of the contents and the index just past its end
+#   The index just past the closing </anything>
+def FindBracketedSpan(s: str, pos: int=0, end: int=-1) -> Optional[tuple[int, str, int, int, int]]:
+    if end < 0:
+        end=len(s)
+
+    while True:
+        lt=s.find("<", pos, end)
+        if lt < 0:
+            return None
+
+        # The bracket's name is the run of letters, digits and spaces following the <
+        nameEnd=lt+1
+        while nameEnd < end and s[nameEnd] in _TAG_NAME_CHARS:
+            nameEnd+=1
+        if nameEnd > lt+1:
+            gt=s.find(">", nameEnd, end)
+            if gt < 0:
+                return None
+            # Anything between the name and the > (e.g., attributes) is ignored, and the name may be shortened to find a matching close
+            for nameLast in range(nameEnd, lt+1, -1):
+                name=s[lt+1:nameLast]
+                close=s.find(f"</{name}>", gt+1, end)
+                if close >= 0:
+                    return lt, name, gt+1, close, close+len(name)+3
+
+        # This < doesn't start a bracketed pair, so look for the next one
+        pos=lt+1
+
+#=====================================================================================
+# Iterate through each top-level <anything>...</anything> in s[start:end], yielding a tuple of the name of the brackets and the
+# start and end indexes of their contents in s
+# Material between the bracketed pairs is ignored
+def IterBracketedSpans(s: str, start: int=0, end: int=-1) -> Iterator[tuple[str, int, int]]:
+    pos=start
+    while True:
+        span=FindBracketedSpan(s, pos, end)
+        if span is None:
+            return
+        _, bracket, contentStart, contentEnd, pos=span
+        yield bracket, contentStart, contentEnd
+
+# The same, but yielding a tuple of the name of the brackets and their contents
+def IterBracketedText(s: str, start: int=0, end: int=-1) -> Iterator[tuple[str, str]]:
+    for bracket, contentStart, contentEnd in IterBracketedSpans(s, start, end):
+        yield bracket, s[contentStart:contentEnd]
 
 
 ######################################